@@ -1,15 +1,26 @@
 # main.py
-import os, re, time, json, hashlib, datetime, threading
-import urllib.parse
-from typing import Tuple
+import os, re, time, json, threading, queue, atexit
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple
 
 import requests
+import xxhash
 from flask import Flask, jsonify
+from selectolax.lexbor import LexborHTMLParser
 
 # =========================
 # ====== Config ===========
 # =========================
 OUTLIER_URL = "https://app.outlier.ai/projects"
+# Endpoint JSON mà trang /projects gọi (lấy 1 lần từ DevTools). Để trống ⇒ chỉ dùng Playwright
+OUTLIER_API_URL = os.getenv("OUTLIER_API_URL", "").strip()
+# Key trong JSON trả về chứa đúng danh sách task (không phải project). Để trống ⇒ không dùng fast path
+OUTLIER_API_TASKS_KEY = os.getenv("OUTLIER_API_TASKS_KEY", "").strip()
+# URL rẻ để dò thay đổi trước khi render. Để trống ⇒ không probe
+# (khi đã có OUTLIER_API_URL thì fast path vốn đã rẻ, probe chỉ thêm 1 request)
+OUTLIER_PROBE_URL = os.getenv("OUTLIER_PROBE_URL", "").strip()
 
 OUTLIER_COOKIE = os.getenv("OUTLIER_COOKIE", "").strip()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
@@ -20,14 +31,24 @@ CHECK_INTERVAL_SEC = int(os.getenv("CHECK_INTERVAL_SEC",
 STATE_FILE = "state.json"
 HAS_STREAK_MIN = 2  # cần >=2 lần liên tiếp thấy has_tasks mới notify
 NOTIFY_ON_FIRST_RUN = False  # lần chạy đầu không notify
+MAX_BACKOFF_SEC = 3600  # trần thời gian chờ khi lỗi / login_required liên tiếp
+IDLE_ROUNDS_BEFORE_STRETCH = 3  # số lần no_tasks liên tiếp trước khi giãn chu kỳ
+IDLE_MAX_INTERVAL_SEC = int(
+    os.getenv("IDLE_MAX_INTERVAL_SEC",
+              str(CHECK_INTERVAL_SEC * 3)))  # trần chu kỳ khi trống task lâu
+TG_DEDUP_TTL_SEC = 600  # tin Telegram trùng nội dung trong khoảng này sẽ bị bỏ qua
+TG_DEDUP_SIZE = 5  # số tin gần nhất được nhớ để chống trùng
+CHECK_CACHE_SEC = 30  # /check gọi lại trong khoảng này trả kết quả cũ
+PROBE_MAX_SKIPS = 12  # probe không đổi quá số lần này vẫn render lại 1 lần cho chắc
 
 # =========================
 # ====== HTTP session =====
 # =========================
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+
 session = requests.Session()
 session.headers.update({
-    "User-Agent":
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "User-Agent": USER_AGENT,
     "Cookie": OUTLIER_COOKIE,
 })
 
@@ -41,17 +62,38 @@ def load_state():
             s = json.load(f)
     except Exception:
         s = {}
+    last_hash = s.get("last_hash", "")
+    # Hash dạng "<nguồn>:<xxh3_64>"; hash cũ (md5 / không có nguồn) không so được ⇒ xoá 1 lần
+    if not re.fullmatch(r"(api|dom):[0-9a-f]{16}", last_hash):
+        last_hash = ""
     return {
-        "last_hash": s.get("last_hash", ""),
+        "last_hash": last_hash,
         "last_status": s.get("last_status", "unknown"),
         "last_checked": s.get("last_checked"),
         "has_streak": s.get("has_streak", 0),
+        "last_hash_probe": s.get("last_hash_probe", ""),
+        "probe_skips": s.get("probe_skips", 0),
     }
 
 
+_last_written = None  # nội dung đã ghi gần nhất, để bỏ qua ghi trùng
+_state_lock = threading.Lock()  # loop nền và các request Flask (/reset) cùng ghi
+
+
 def save_state(st):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(st, f, ensure_ascii=False, indent=2)
+    """Chỉ ghi khi state thay đổi; ghi ra file tạm rồi os.replace để không hỏng file khi crash"""
+    global _last_written
+    with _state_lock:
+        blob = json.dumps(st, ensure_ascii=False, separators=(",", ":"))
+        if blob == _last_written:
+            return
+        tmp = STATE_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(blob.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, STATE_FILE)
+        _last_written = blob
 
 
 state = load_state()
@@ -60,6 +102,10 @@ state = load_state()
 # =========================
 # ====== Telegram =========
 # =========================
+# Session riêng giữ kết nối keep-alive tới api.telegram.org (không bắt tay TLS lại mỗi lần)
+tg_session = requests.Session()
+
+
 def tg_send(msg: str):
     """Gửi tin nhắn Telegram bằng GET request"""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
@@ -69,168 +115,424 @@ def tg_send(msg: str):
         print("⚠️ Tin nhắn trống, bỏ qua.")
         return
 
-    # Encode nội dung để an toàn (ví dụ: dấu cách, tiếng Việt, ký tự đặc biệt)
-    encoded_msg = urllib.parse.quote_plus(msg.strip())
-    url = (f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-           f"?chat_id={TELEGRAM_CHAT_ID}&text={encoded_msg}&parse_mode=HTML")
+    # requests tự encode params (dấu cách, tiếng Việt, ký tự đặc biệt)
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    params = {
+        "chat_id": TELEGRAM_CHAT_ID,
+        "text": msg.strip(),
+        "parse_mode": "HTML"
+    }
 
     try:
-        r = requests.get(url, timeout=20)
+        r = tg_session.get(url, params=params, timeout=20)
         r.raise_for_status()
         print("✅ Đã gửi Telegram:", msg)
     except Exception as e:
         print("🚫 Lỗi gửi Telegram:", e)
 
 
+# 1 thread nền gửi Telegram theo thứ tự, để check_once không phải chờ mạng
+_tg_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="telegram")
+
+
+def tg_notify(msg: str):
+    """Đưa tin nhắn vào hàng đợi gửi nền, trả về ngay"""
+    _tg_pool.submit(tg_send, msg)
+
+
+# Nhớ vài tin đã gửi gần đây {hash: thời điểm} để không gửi lặp cùng 1 nội dung
+_tg_recent = OrderedDict()
+_tg_recent_lock = threading.Lock()
+
+
+def _dedup_send(msg: str, key: str = ""):
+    """
+    Như tg_notify, nhưng bỏ qua tin trùng đã gửi trong TG_DEDUP_TTL_SEC.
+    key: phân biệt các tin có cùng nội dung chữ (vd. hash trang cho tin task mới)
+    """
+    h = xxhash.xxh3_64_hexdigest(f"{key}\n{msg}".encode("utf-8", "ignore"))
+    now = time.time()
+    with _tg_recent_lock:
+        ts = _tg_recent.get(h)
+        if ts is not None and now - ts < TG_DEDUP_TTL_SEC:
+            print("↩️ Bỏ qua tin Telegram trùng:", msg)
+            return
+        _tg_recent[h] = now
+        _tg_recent.move_to_end(h)
+        while len(_tg_recent) > TG_DEDUP_SIZE:
+            _tg_recent.popitem(last=False)
+    tg_notify(msg)
+
+
 # =========================
 # === Headless Playwright ==
 # =========================
 # YÊU CẦU: pip install playwright  +  python -m playwright install chromium
+_COOKIE_RE = re.compile(r"([^=;\s]+)\s*=([^;]*)")
+
+
+@lru_cache(maxsize=4)
 def _parse_cookie_string(cookie_str: str, domain: str):
-    pairs = [c.strip() for c in cookie_str.split(";") if "=" in c]
-    cookies = []
-    for p in pairs:
-        name, value = p.split("=", 1)
-        cookies.append({
-            "name": name.strip(),
-            "value": value.strip(),
-            "domain": domain,
-            "path": "/",
-            "httpOnly": False,
-            "secure": True
-        })
-    return cookies
-
-
-def render_and_read() -> Tuple[str, str]:
+    # OUTLIER_COOKIE không đổi trong suốt process ⇒ chỉ parse 1 lần
+    return [{
+        "name": n.strip(),
+        "value": v.strip(),
+        "domain": domain,
+        "path": "/",
+        "httpOnly": False,
+        "secure": True
+    } for n, v in _COOKIE_RE.findall(cookie_str)]
+
+
+# Playwright sync API chỉ dùng được trên thread đã khởi tạo nó, nên browser
+# sống lâu dài trên 1 thread riêng; mọi lần check gửi việc sang thread đó.
+_pw = None
+_browser = None
+_ctx = None
+_pw_lock = threading.Lock()
+_pw_jobs = queue.Queue()
+_pw_thread = None
+
+
+def _pw_worker():
+    while True:
+        fn, fut = _pw_jobs.get()
+        try:
+            fut.set_result(fn())
+        except BaseException as e:
+            fut.set_exception(e)
+
+
+def _run_on_pw_thread(fn, timeout=None):
+    global _pw_thread
+    with _pw_lock:
+        if _pw_thread is None:
+            _pw_thread = threading.Thread(target=_pw_worker,
+                                          name="playwright",
+                                          daemon=True)
+            _pw_thread.start()
+    fut = Future()
+    _pw_jobs.put((fn, fut))
+    return fut.result(timeout=timeout)
+
+
+# Replit cần --no-sandbox; các cờ còn lại tắt tính năng nền không cần cho việc đọc DOM
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--disable-background-networking",
+    "--disable-extensions",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--disable-features=Translate,BackForwardCache,InterestCohort",
+]
+
+
+def _get_browser():
+    """Khởi tạo Chromium 1 lần (hoặc khi bị crash), tái dùng cho mọi lần check."""
+    global _pw, _browser
+    if _browser is None or not _browser.is_connected():
+        from playwright.sync_api import sync_playwright
+        if _pw is None:
+            _pw = sync_playwright().start()
+        _browser = _pw.chromium.launch(
+            headless=True,
+            args=CHROMIUM_ARGS,
+            ignore_default_args=["--enable-automation"])
+    return _browser
+
+
+def _get_context():
     """
-    Mở https://app.outlier.ai/projects, đợi JS gọi API xong, rồi đọc text trong
-    <div class="radix-themes">…</div>.
-    Trả: (status, content_hash_text)
-      - status: 'no_tasks' | 'has_tasks' | 'login_required' | 'unknown'
-      - content_hash_text: chuỗi text để hash (chống spam notify)
+    Context dùng chung cho mọi lần check: cookie, route lọc request và script
+    đếm pending chỉ cài 1 lần, page mới tạo ra tự thừa hưởng.
     """
-    from playwright.sync_api import sync_playwright
+    global _ctx
+    browser = _get_browser()
+    if _ctx is None or _ctx.browser is not browser:
+        # Chặn service worker để không có fetch nền chạy ngoài route/__pending
+        _ctx = browser.new_context(
+            viewport={"width": 1280, "height": 800},
+            user_agent=USER_AGENT,
+            service_workers="block")
+        _ctx.add_cookies(_parse_cookie_string(OUTLIER_COOKIE, ".outlier.ai"))
+        # Chặn analytics/telemetry: vừa tải nhanh hơn, vừa không làm nhiễu __pending
+        # (nhờ đó không cần chờ "networkidle" vốn hay bị các request nền giữ lại).
+        # Chỉ route đúng các host này: route "**/*" bắt mọi request đi vòng qua Python
+        # và tắt HTTP cache ⇒ mất cache JS bundle của app giữa các lần check
+        _ctx.route(_BLOCKED_RE, lambda route: route.abort())
+        # Inject đếm pending fetch/xhr để biết khi nào im lặng
+        _ctx.add_init_script(PENDING_JS)
+    return _ctx
 
-    cookie_str = OUTLIER_COOKIE
-    if not cookie_str:
-        return "login_required", ""
 
-    with sync_playwright() as p:
-        # Replit cần --no-sandbox
-        browser = p.chromium.launch(headless=True, args=["--no-sandbox", "--disable-gpu", "--disable-dev-shm-usage"])
-        ctx = browser.new_context()
-        ctx.add_cookies(_parse_cookie_string(cookie_str, ".outlier.ai"))
+def _close_browser():
+    global _pw, _browser, _ctx
+    _ctx = None
+    if _browser is not None:
+        _browser.close()
+        _browser = None
+    if _pw is not None:
+        _pw.stop()
+        _pw = None
 
-        page = ctx.new_page()
 
-        # Inject đếm pending fetch/xhr để biết khi nào im lặng
-        page.add_init_script("""
-            (function () {
-              const origFetch = window.fetch;
-              window.__pending = 0;
-              window.fetch = async function() {
-                window.__pending++;
-                try { return await origFetch.apply(this, arguments); }
-                finally { window.__pending--; }
-              };
-              const open = XMLHttpRequest.prototype.open;
-              const send = XMLHttpRequest.prototype.send;
-              XMLHttpRequest.prototype.open = function() { this.addEventListener('loadend', () => { window.__pending = Math.max(0, window.__pending-1); }); open.apply(this, arguments); };
-              XMLHttpRequest.prototype.send = function() { window.__pending++; try { send.apply(this, arguments); } catch(e){ window.__pending = Math.max(0, window.__pending-1); throw e; } };
-            })();
-        """)
+@atexit.register
+def _shutdown_browser():
+    if _pw_thread is None:
+        return
+    try:
+        _run_on_pw_thread(_close_browser, timeout=10)
+    except Exception:
+        pass
+
+
+PENDING_JS = """
+(function () {
+  const origFetch = window.fetch;
+  window.__pending = 0;
+  window.fetch = async function() {
+    window.__pending++;
+    try { return await origFetch.apply(this, arguments); }
+    finally { window.__pending--; }
+  };
+  const open = XMLHttpRequest.prototype.open;
+  const send = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.open = function() { this.addEventListener('loadend', () => { window.__pending = Math.max(0, window.__pending-1); }); open.apply(this, arguments); };
+  XMLHttpRequest.prototype.send = function() { window.__pending++; try { send.apply(this, arguments); } catch(e){ window.__pending = Math.max(0, window.__pending-1); throw e; } };
+})();
+"""
+PENDING_IDLE_JS = "() => (window.__pending ?? 0) === 0"
+READY_JS = ("() => !!document.querySelector('div.radix-themes')"
+            " && (window.__pending ?? 0) === 0")
+BLOCKED_HOSTS = ("segment.io", "google-analytics", "datadog", "hotjar",
+                 "sentry.io")
+
+_BLOCKED_RE = re.compile("|".join(map(re.escape, BLOCKED_HOSTS)))
+
+
+LOGIN_MARKERS = ("sign in", "log in", "continue with google", "next-auth")
+NO_MARKERS = ("no tasks available", "there are no tasks", "you have no tasks")
+POSITIVE_STRONG = (
+    "start task",
+    "continue task",
+    "available tasks",
+    "accept task",
+    "project details",  # xuất hiện khi có project hiển thị
+    "assigned to you",
+)
+
+
+def _render_page() -> str:
+    """
+    Chạy trên thread playwright. Mỗi lần check chỉ mở 1 page mới trong context
+    dùng chung và đóng page khi xong.
+    Trả: HTML của trang sau khi JS đã tải xong dữ liệu
+    """
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 
+    page = _get_context().new_page()
+    try:
         # Vào trang và chờ DOM sẵn
         page.goto(OUTLIER_URL, wait_until="domcontentloaded", timeout=30000)
-        # Thử chờ network idle (có thể không đạt do socket keep-alive)
+
+        # Chờ 1 lần duy nhất tới khi có container .radix-themes VÀ pending request
+        # về 0 (tối đa 25s). Predicate chạy trong trang ⇒ xong là trả về ngay.
         try:
-            page.wait_for_load_state("networkidle", timeout=12000)
-        except:
+            page.wait_for_function(READY_JS, timeout=25000)
+        except PlaywrightTimeoutError:
+            # Chưa có container (khả năng chưa login) hoặc request chưa dứt ⇒ đọc luôn
             pass
+        else:
+            # Xác nhận pending vẫn ổn định ở 0 sau ~2s
+            page.wait_for_timeout(2000)
+            try:
+                page.wait_for_function(PENDING_IDLE_JS, timeout=5000)
+            except PlaywrightTimeoutError:
+                pass
 
-        # Chờ selector .radix-themes xuất hiện (tối đa 20s)
-        try:
-            page.wait_for_selector("div.radix-themes", timeout=20000)
-        except:
-            # Không có container ⇒ khả năng chưa login
-            txt = page.inner_text("body")
-            ctx.close()
-            browser.close()
-            low = txt.lower()
-            if any(k in low for k in
-                   ["sign in", "log in", "continue with google", "next-auth"]):
-                return "login_required", txt
-            return "unknown", txt
-
-        # Đợi pending request về 0 ổn định ~2s (tổng tối đa 25s)
-        t0 = time.time()
-        while time.time() - t0 < 25:
-            pending = page.evaluate("window.__pending ?? 0")
-            if pending == 0:
-                time.sleep(2)
-                if page.evaluate("window.__pending ?? 0") == 0:
-                    break
-            time.sleep(0.3)
-
-        # Lấy text trong vùng radix-themes
-        try:
-            content_text = page.inner_text("div.radix-themes")
-        except:
-            content_text = page.inner_text("body")
+        # Lấy HTML thô; tách text bằng selectolax thay vì inner_text (khỏi tính layout)
+        return page.content()
+    finally:
+        page.close()
+
+
+HIDDEN_SELECTOR = ('[hidden], [aria-hidden="true"], [style*="display:none"],'
+                   ' [style*="display: none"]')
+
+
+def _extract_text(html: str) -> Tuple[bool, str]:
+    """
+    Lấy text trong <div class="radix-themes"> (hoặc cả body nếu không có).
+    Trả: (có_container_radix_themes, text)
+    """
+    tree = LexborHTMLParser(html)
+    tree.strip_tags(["script", "style", "noscript"])
+    # .text() lấy cả node ẩn (inner_text thì bỏ qua) ⇒ gỡ node ẩn trước để
+    # chữ ẩn như "Log in" / "Project details" không làm sai phân loại
+    for hidden in tree.css(HIDDEN_SELECTOR):
+        hidden.decompose()
+    node = tree.css_first("div.radix-themes")
+    found = node is not None
+    if not found:
+        node = tree.body
+    text = node.text(separator=" ") if node is not None else ""
+    # .text() giữ nguyên khoảng trắng của DOM (khác inner_text) ⇒ gộp lại để
+    # marker nhiều từ như "no tasks available" vẫn khớp
+    return found, " ".join(text.split())
+
+
+def _fast_read() -> Optional[Tuple[str, str]]:
+    """
+    Gọi thẳng API JSON bằng cookie, không cần mở Chromium.
+    Trả None khi chưa cấu hình OUTLIER_API_URL / OUTLIER_API_TASKS_KEY, lỗi mạng,
+    non-200 hoặc JSON không đúng dạng ⇒ render_and_read fallback sang Playwright.
+    """
+    if not OUTLIER_API_URL or not OUTLIER_API_TASKS_KEY:
+        return None
+    try:
+        r = session.get(OUTLIER_API_URL, timeout=15, allow_redirects=False)
+        if r.status_code != 200:
+            return None
+        data = r.json()
+    except Exception:
+        return None
+
+    # Chỉ tin đúng key đã cấu hình; list project luôn có "Current project" nên
+    # không phải dấu hiệu có task ⇒ sai dạng thì để Playwright phân loại
+    if not isinstance(data, dict):
+        return None
+    tasks = data.get(OUTLIER_API_TASKS_KEY)
+    if not isinstance(tasks, list):
+        return None
+
+    evidence = json.dumps(tasks, ensure_ascii=False, sort_keys=True)
+    return ("has_tasks" if tasks else "no_tasks"), evidence
+
+
+def fast_probe() -> Optional[str]:
+    """GET rẻ tới OUTLIER_PROBE_URL, trả hash của body (None nếu không dùng được)"""
+    if not OUTLIER_PROBE_URL or not OUTLIER_COOKIE:
+        return None
+    try:
+        r = session.get(OUTLIER_PROBE_URL, timeout=15, allow_redirects=False)
+    except Exception:
+        return None
+    if r.status_code != 200:
+        return None
+    return xxhash.xxh3_64_hexdigest(r.content)
+
+
+def render_and_read() -> Tuple[str, str, str]:
+    """
+    Mở https://app.outlier.ai/projects, đợi JS gọi API xong, rồi đọc text trong
+    <div class="radix-themes">…</div>.
+    Trả: (status, content_hash_text, source)
+      - status: 'no_tasks' | 'has_tasks' | 'login_required' | 'unknown'
+      - content_hash_text: chuỗi text để hash (chống spam notify)
+      - source: 'api' (fast path JSON) | 'dom' (Playwright) — 2 nguồn hash khác nhau
+    """
+    if not OUTLIER_COOKIE:
+        return "login_required", "", "dom"
 
-        ctx.close()
-        browser.close()
+    fast = _fast_read()
+    if fast is not None:
+        return fast[0], fast[1], "api"
 
+    found, content_text = _extract_text(_run_on_pw_thread(_render_page))
+    # Mỗi nhóm marker quét riêng bằng `in` trên 1 bản lower: không bị khớp
+    # chồng lấn che mất nhau (như 1 regex alternation) và nhanh hơn
     low = content_text.lower()
 
     # Login?
-    if any(k in low for k in
-           ["sign in", "log in", "continue with google", "next-auth"]):
-        return "login_required", content_text
+    if any(k in low for k in LOGIN_MARKERS):
+        return "login_required", content_text, "dom"
+    # Không có container ⇒ khả năng chưa login, không phân loại tiếp
+    if not found:
+        return "unknown", content_text, "dom"
 
     # Quy tắc phân loại:
     # - Nếu rõ ràng có "No tasks available" => no_tasks
     # - Ngược lại: nếu xuất hiện các nút/hành động đặc trưng khi có task
     #   (ví dụ nút "Project details" kèm badge nhiệm vụ…), coi như has_tasks.
     # - Nếu không tìm thấy gì chắc chắn => unknown
-    no_markers = [
-        "no tasks available", "there are no tasks", "you have no tasks"
-    ]
-    if any(m in low for m in no_markers):
-        return "no_tasks", content_text
-
-    positive_strong = [
-        "start task",
-        "continue task",
-        "available tasks",
-        "accept task",
-        "project details",  # xuất hiện khi có project hiển thị
-        "assigned to you",
-    ]
-    if any(m in low for m in positive_strong):
-        return "has_tasks", content_text
-
-    # fallback: nếu container có “Current project” + KHÔNG có "no tasks available"
-    if "current project" in low and not any(m in low for m in no_markers):
-        # Cẩn thận: chữ 'Current project' luôn có, nhưng nếu không có 'no tasks available'
-        # ta chỉ tạm đánh dấu unknown, tránh báo ảo
-        return "unknown", content_text
-
-    return "unknown", content_text
+    #   (chữ "Current project" luôn có nên không đủ để coi là has_tasks, tránh báo ảo)
+    if any(m in low for m in NO_MARKERS):
+        return "no_tasks", content_text, "dom"
+    if any(m in low for m in POSITIVE_STRONG):
+        return "has_tasks", content_text, "dom"
+    return "unknown", content_text, "dom"
 
 
 # =========================
 # ====== One check ========
 # =========================
-def check_once():
-    now = datetime.datetime.utcnow().isoformat() + "Z"
+_ISO_TS_RE = re.compile(r"\d{4}-\d{2}-\d{2}T[\d:.Z+-]+")
+
+
+def _now_iso() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def _normalize_evidence(text: str) -> str:
+    """Bỏ timestamp và khoảng trắng thừa để hash không đổi vì chi tiết vụn vặt"""
+    return " ".join(_ISO_TS_RE.sub("", text).split())
+
+
+# Chỉ 1 lượt check chạy tại 1 thời điểm (loop nền + /check), tránh đua nhau sửa state
+check_sem = threading.BoundedSemaphore(1)
+
+
+def check_once(wait: bool = True):
+    """wait=False: nếu đang có lượt check khác chạy thì trả ngay kết quả cũ (stale)"""
+    if not check_sem.acquire(blocking=wait):
+        return {
+            "ok": (state.get("last_checked") is not None
+                   and state.get("last_status") != "login_required"),
+            "status": state.get("last_status"),
+            "changed": False,
+            "streak": state.get("has_streak", 0),
+            "time": state.get("last_checked"),
+            "stale": True
+        }
     try:
-        status_text, evidence_text = render_and_read()
+        return _check_once()
+    finally:
+        check_sem.release()
+
+
+def _check_once():
+    now = _now_iso()
+    try:
+        # Trang vẫn trống / chưa rõ và probe không đổi ⇒ khỏi render lại
+        probe_hash = fast_probe()
+        skips = int(state.get("probe_skips", 0))
+        if (probe_hash and probe_hash == state.get("last_hash_probe")
+                and state.get("last_status") in ("no_tasks", "unknown")
+                and skips < PROBE_MAX_SKIPS):
+            state["last_checked"] = now
+            state["probe_skips"] = skips + 1
+            save_state(state)
+            print(f"[{now}] probe unchanged -> status={state['last_status']}")
+            return {
+                "ok": True,
+                "status": state["last_status"],
+                "changed": False,
+                "streak": state.get("has_streak", 0),
+                "time": now,
+                "probe_skipped": True
+            }
+
+        status_text, evidence_text, source = render_and_read()
+        state["last_hash_probe"] = probe_hash or ""
+        state["probe_skips"] = 0
         if status_text == "login_required":
             state.update({"last_status": status_text, "last_checked": now})
             save_state(state)
-            tg_send(
+            _dedup_send(
                 "⚠️ Cookie có thể hết hạn hoặc yêu cầu đăng nhập. Hãy cập nhật OUTLIER_COOKIE."
             )
             print(f"[{now}] login_required")
@@ -243,24 +545,31 @@ def check_once():
             }
 
         # Hash nội dung container để phát hiện thay đổi thực sự
-        content_hash = hashlib.md5(evidence_text.encode("utf-8",
-                                                        "ignore")).hexdigest()
+        # (kèm nguồn, vì JSON của API và text của trang không so với nhau được)
+        content_hash = source + ":" + xxhash.xxh3_64_hexdigest(
+            _normalize_evidence(evidence_text).encode("utf-8", "ignore"))
 
         prev_hash = state.get("last_hash", "")
+        prev_source = prev_hash.split(":", 1)[0] if prev_hash else ""
         prev_streak = int(state.get("has_streak", 0))
         first_run = (state.get("last_checked") is None)
 
-        changed = (content_hash
-                   != prev_hash) if status_text != "unknown" else False
+        if status_text == "unknown":
+            changed = False
+        elif prev_source and prev_source != source:
+            # Đổi nguồn (API lỗi ⇒ fallback Playwright hoặc ngược lại) ⇒ không tính là thay đổi
+            changed = False
+        else:
+            changed = content_hash != prev_hash
         has_streak = (prev_streak + 1) if status_text == "has_tasks" else 0
 
         should_notify = (status_text == "has_tasks"
                          and has_streak >= HAS_STREAK_MIN and changed
                          and (NOTIFY_ON_FIRST_RUN or not first_run))
         if should_notify:
-            tg_send(
-                "🔔 <b>Outlier</b>: Có dấu hiệu <b>task mới</b>. Vào kiểm tra: https://app.outlier.ai/projects"
-            )
+            _dedup_send(
+                "🔔 <b>Outlier</b>: Có dấu hiệu <b>task mới</b>. Vào kiểm tra: https://app.outlier.ai/projects",
+                key=content_hash)
 
         if status_text != "unknown":
             state["last_hash"] = content_hash
@@ -282,7 +591,7 @@ def check_once():
 
     except Exception as e:
         print(f"[{now}] ERROR:", e)
-        tg_send(f"⚠️ Outlier checker lỗi: {e}")
+        _dedup_send(f"⚠️ Outlier checker lỗi: {e}")
         return {"ok": False, "error": str(e), "time": now}
 
 
@@ -296,12 +605,40 @@ def loop_worker():
         print(
             "Service vẫn chạy, nhưng /check sẽ fail cho đến khi cung cấp cookie."
         )
+    fail_count = 0
+    idle_rounds = 0
+    idle_interval = CHECK_INTERVAL_SEC
     while True:
         try:
-            check_once()
+            res = check_once()
         except Exception as ex:
             print("Loop error:", ex)
-        time.sleep(CHECK_INTERVAL_SEC)
+            res = {"ok": False}
+
+        if not res.get("ok") or res.get("status") == "login_required":
+            # Lỗi / hết cookie liên tiếp ⇒ backoff lũy thừa, tránh spam Telegram
+            delay = min(CHECK_INTERVAL_SEC * 2**fail_count, MAX_BACKOFF_SEC)
+            fail_count = min(fail_count + 1, 16)
+            idle_rounds = 0
+            idle_interval = CHECK_INTERVAL_SEC
+        else:
+            fail_count = 0
+            if res.get("status") == "no_tasks":
+                idle_rounds += 1
+            else:
+                idle_rounds = 0
+                idle_interval = CHECK_INTERVAL_SEC
+
+            if 0 < res.get("streak", 0) < HAS_STREAK_MIN:
+                # Streak has_tasks chưa đủ để notify ⇒ kiểm tra lại sớm để xác nhận
+                delay = CHECK_INTERVAL_SEC / 2
+            elif idle_rounds > IDLE_ROUNDS_BEFORE_STRETCH:
+                # Trống task lâu ⇒ giãn dần chu kỳ (x1.5) tới mức trần
+                idle_interval = min(idle_interval * 1.5, IDLE_MAX_INTERVAL_SEC)
+                delay = idle_interval
+            else:
+                delay = CHECK_INTERVAL_SEC
+        time.sleep(delay)
 
 
 # =========================
@@ -325,9 +662,23 @@ def health():
     return "ok"
 
 
+# Kết quả /check gần nhất (thời điểm, kết quả) ⇒ gọi dồn trong CHECK_CACHE_SEC chỉ render 1 lần
+_last_check = (0.0, None)
+
+
 @app.get("/check")
 def manual_check():
-    return jsonify(check_once())
+    global _last_check
+    with _state_lock:
+        ts, res = _last_check
+    if res and time.time() - ts < CHECK_CACHE_SEC:
+        return jsonify({**res, "cached": True})
+
+    res = check_once(wait=False)
+    if not res.get("stale"):
+        with _state_lock:
+            _last_check = (time.time(), res)
+    return jsonify(res)
 
 
 @app.get("/env")
@@ -343,14 +694,20 @@ def env_info():
 
 @app.get("/reset")
 def reset_state():
-    global state
-    state = {
-        "last_hash": "",
-        "last_status": "unknown",
-        "last_checked": None,
-        "has_streak": 0
-    }
-    save_state(state)
+    global state, _last_check
+    # Chờ lượt check đang chạy xong, tránh check đó ghi đè lên state vừa reset
+    with check_sem:
+        state = {
+            "last_hash": "",
+            "last_status": "unknown",
+            "last_checked": None,
+            "has_streak": 0,
+            "last_hash_probe": "",
+            "probe_skips": 0
+        }
+        save_state(state)
+        with _state_lock:
+            _last_check = (0.0, None)
     return jsonify(state)
 
 